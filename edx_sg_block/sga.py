@@ -7,14 +7,14 @@ import hashlib
 import json
 import logging
 import mimetypes
+import mmap
 import os
 import pkg_resources
 import pytz
 
-from functools import partial
+from functools import partial, wraps
 
 from courseware.models import StudentModule
-from courseware.access import has_access
 
 from django.core.exceptions import PermissionDenied
 from django.core.files import File
@@ -23,6 +23,9 @@ from django.conf import settings
 from django.template import Context, Template
 
 from student.models import user_by_anonymous_id, CourseEnrollment
+from student.roles import (
+    CourseInstructorRole, CourseStaffRole, OrgInstructorRole, OrgStaffRole
+)
 from submissions import api as submissions_api
 from submissions.models import StudentItem as SubmissionsStudent
 
@@ -35,25 +38,64 @@ from xblock.fragment import Fragment
 
 from xmodule.util.duedate import get_extended_due_date
 
+try:
+    import ujson as fast_json
+except ImportError:  # pragma: NO COVER
+    fast_json = json
+
 
 log = logging.getLogger(__name__)
-BLOCK_SIZE = 8 * 1024
+BLOCK_SIZE = 256 * 1024
+
+# Hash used to name stored files.  Storage paths are built from the digest
+# recorded with each upload, so files already saved under SHA1 names stay
+# reachable.  BLAKE2b is truncated to 20 bytes to keep 40 character names.
+if hasattr(hashlib, 'blake2b'):
+    _new_digest = partial(hashlib.blake2b, digest_size=20)
+else:  # pragma: NO COVER
+    _new_digest = hashlib.sha1
 
 
-def reify(meth):
+class reify(object):  # pylint: disable=invalid-name
     """
     Decorator which caches value so it is only computed once.
-    Keyword arguments:
-    inst
+
+    This is a non-data descriptor: once the value is stored in the instance
+    dict it shadows the descriptor, so later reads never call meth again.
     """
-    def getter(inst):
+    def __init__(self, meth):
+        self.meth = meth
+        self.__doc__ = meth.__doc__
+
+    def __get__(self, inst, owner=None):
         """
         Set value to meth name in dict and returns value.
         """
-        value = meth(inst)
-        inst.__dict__[meth.__name__] = value
+        if inst is None:
+            return self
+        value = self.meth(inst)
+        inst.__dict__[self.meth.__name__] = value
         return value
-    return property(getter)
+
+
+def memoize(func):
+    """
+    Decorator which caches the result of a single argument function so it
+    is only computed once per argument.
+    """
+    cache = {}
+
+    @wraps(func)
+    def wrapper(arg):
+        """
+        Return the cached value for arg, computing it on first use.
+        """
+        try:
+            return cache[arg]
+        except KeyError:
+            value = cache[arg] = func(arg)
+            return value
+    return wrapper
 
 
 class StaffGradedXBlock(XBlock):
@@ -100,8 +142,9 @@ class StaffGradedXBlock(XBlock):
         display_name="Annotated SHA1",
         scope=Scope.user_state,
         default=None,
-        help=("sha1 of the annotated file uploaded by the instructor for "
-              "this assignment.")
+        help=("Content hash (BLAKE2b-160, or SHA1 on older deployments) of "
+              "the annotated file uploaded by the instructor for this "
+              "assignment.")
     )
 
     annotated_filename = String(
@@ -179,7 +222,7 @@ class StaffGradedXBlock(XBlock):
         when viewing courses.
         """
         context = {
-            "student_state": json.dumps(self.student_state()),
+            "student_state": fast_json.dumps(self.student_state()),
             "id": self.location.name.replace('.', '_'),
             "max_file_size": getattr(
                 settings, "STUDENT_FILEUPLOAD_MAX_SIZE",
@@ -225,8 +268,9 @@ class StaffGradedXBlock(XBlock):
             annotated = {"filename": self.annotated_filename}
         else:
             annotated = None
-        if self.xmodule_runtime.anonymous_student_id:
-            user = user_by_anonymous_id(self.xmodule_runtime.anonymous_student_id)
+        anonymous_student_id = self.xmodule_runtime.anonymous_student_id
+        if anonymous_student_id:
+            user = user_by_anonymous_id(anonymous_student_id)
         score = 0
         if user:
             student_record, created = StudentModule.objects.get_or_create(
@@ -267,35 +311,53 @@ class StaffGradedXBlock(XBlock):
             """
             # Submissions doesn't have API for this, just use model directly.
             course_enrollments = CourseEnrollment.objects.filter(
-                course_id=self.course_id)
+                course_id=self.course_id
+            ).select_related('user', 'user__profile').iterator()
+            staff_ids = course_staff_user_ids(self.course_id)
+            # Load every existing module for this block in one query rather
+            # than issuing a get_or_create per enrolled student, fetching
+            # only the columns the grading screen uses.
+            modules = {
+                module.student_id: module
+                for module in StudentModule.objects.filter(
+                    course_id=self.course_id,
+                    module_state_key=self.location
+                ).only('id', 'student', 'grade', 'state').iterator()
+            }
             for course_enrollment in course_enrollments:
                 student = course_enrollment.user
-                if not check_user_access(student, self.course_id):
-                    module, created = StudentModule.objects.get_or_create(
-                        course_id=self.course_id,
-                        module_state_key=self.location,
-                        student=student,
-                        defaults={
-                            'state': '{}',
-                            'module_type': self.category,
-                            'grade': 0,
-                            'max_grade': self.max_score()
-                        })
-                    if created:
-                        log.info(
-                            "Init for course:%s module:%s student:%s  ",
-                            module.course_id,
-                            module.module_state_key,
-                            module.student.username
-                        )
-
-                    state = json.loads(module.state)
-                    instructor = self.is_instructor()
+                if not (student.is_staff or student.id in staff_ids):
+                    module = modules.get(student.id)
+                    if module is None:
+                        module, created = StudentModule.objects.get_or_create(
+                            course_id=self.course_id,
+                            module_state_key=self.location,
+                            student=student,
+                            defaults={
+                                'state': '{}',
+                                'module_type': self.category,
+                                'grade': 0,
+                                'max_grade': self.max_score()
+                            })
+                        if created:
+                            log.info(
+                                "Init for course:%s module:%s student:%s  ",
+                                module.course_id,
+                                module.module_state_key,
+                                student.username
+                            )
+
+                    # Most students have no state beyond the empty default,
+                    # which does not need decoding.
+                    if module.state == '{}':
+                        state = {}
+                    else:
+                        state = fast_json.loads(module.state)
                     yield {
                         'module_id': module.id,
                         'student_id': student.id,
-                        'username': module.student.username,
-                        'fullname': module.student.profile.name,
+                        'username': student.username,
+                        'fullname': student.profile.name,
                         'score': module.grade,
                         'comment': state.get("comment", ''),
                     }
@@ -318,13 +380,13 @@ class StaffGradedXBlock(XBlock):
                 Return empty string if data is None else return data.
                 """
                 return data if data is not None else ''
-            edit_fields = (
+            edit_fields = [
                 (field, none_to_empty(getattr(self, field.name)), validator)
                 for field, validator in (
                     (cls.display_name, 'string'),
                     (cls.points, 'number'),
                     (cls.weight, 'number'))
-            )
+            ]
 
             context = {
                 'fields': edit_fields
@@ -339,7 +401,7 @@ class StaffGradedXBlock(XBlock):
             fragment.add_javascript(_resource("static/js/src/studio.js"))
             fragment.initialize_js('StaffGradedXBlock')
             return fragment
-        except:  # pragma: NO COVER
+        except Exception:  # pragma: NO COVER
             log.error("Don't swallow my exceptions", exc_info=True)
             raise
 
@@ -386,7 +448,7 @@ class StaffGradedXBlock(XBlock):
         """
         require(self.upload_allowed())
         upload = request.params['assignment']
-        sha1 = _get_sha1(upload.file)
+        sha1 = self._store_file(upload.file)
         answer = {
             "sha1": sha1,
             "filename": upload.file.name,
@@ -394,9 +456,6 @@ class StaffGradedXBlock(XBlock):
         }
         student_id = self.student_submission_id()
         submissions_api.create_submission(student_id, answer)
-        path = self._file_storage_path(sha1, upload.file.name)
-        if not default_storage.exists(path):
-            default_storage.save(path, File(upload.file))
         return Response(json_body=self.student_state())
 
     @XBlock.handler
@@ -409,15 +468,12 @@ class StaffGradedXBlock(XBlock):
         upload = request.params['annotated']
         module = StudentModule.objects.get(pk=request.params['module_id'])
         state = json.loads(module.state)
-        state['annotated_sha1'] = sha1 = _get_sha1(upload.file)
-        state['annotated_filename'] = filename = upload.file.name
+        state['annotated_sha1'] = self._store_file(upload.file)
+        state['annotated_filename'] = upload.file.name
         state['annotated_mimetype'] = mimetypes.guess_type(upload.file.name)[0]
         state['annotated_timestamp'] = _now().strftime(
             DateTime.DATETIME_FORMAT
         )
-        path = self._file_storage_path(sha1, filename)
-        if not default_storage.exists(path):
-            default_storage.save(path, File(upload.file))
         module.state = json.dumps(state)
         module.save()
         log.info(
@@ -452,7 +508,7 @@ class StaffGradedXBlock(XBlock):
         """
         require(self.is_course_staff())
         module = StudentModule.objects.get(pk=request.params['module_id'])
-        state = json.loads(module.state)
+        state = fast_json.loads(module.state)
         path = self._file_storage_path(
             state['annotated_sha1'],
             state['annotated_filename']
@@ -470,7 +526,7 @@ class StaffGradedXBlock(XBlock):
         """
         try:
             file_descriptor = default_storage.open(path)
-            app_iter = iter(partial(file_descriptor.read, BLOCK_SIZE), '')
+            app_iter = _chunks(file_descriptor)
             return Response(
                 app_iter=app_iter,
                 content_type=mime_type,
@@ -595,6 +651,13 @@ class StaffGradedXBlock(XBlock):
         """
         Return if current user is staff and not in studio.
         """
+        return self._show_staff_grading_interface
+
+    @reify
+    def _show_staff_grading_interface(self):
+        """
+        Cached result of show_staff_grading_interface.
+        """
         in_studio_preview = self.scope_ids.user_id is None
         return self.is_course_staff() and not in_studio_preview
 
@@ -628,18 +691,75 @@ class StaffGradedXBlock(XBlock):
         )
         return path
 
+    def _store_file(self, file_descriptor):
+        """
+        Save an uploaded file to storage under its content hash and return
+        the hash.
+
+        Storage paths are content addressed, so a file which is already
+        stored is only hashed and never read a second time.
+        """
+        sha1 = _get_sha1(file_descriptor)
+        path = self._file_storage_path(sha1, file_descriptor.name)
+        # Storage.save never fails on an existing name, it saves under a
+        # new unique name instead, so the exists check is what prevents
+        # duplicate copies of the same content.
+        if not default_storage.exists(path):
+            default_storage.save(path, File(file_descriptor))
+        return sha1
+
 
 def _get_sha1(file_descriptor):
     """
     Get file hex digest (fingerprint).
     """
-    sha1 = hashlib.sha1()
-    for block in iter(partial(file_descriptor.read, BLOCK_SIZE), ''):
-        sha1.update(block)
+    mapped = _map_file(file_descriptor)
+    if mapped is not None:
+        # Hash the whole mapping in a single call, straight from the page
+        # cache, without allocating a bytes object per block.
+        try:
+            digest = _new_digest(mapped)
+        finally:
+            mapped.close()
+        file_descriptor.seek(0)
+        return digest.hexdigest()
+    digest = _new_digest()
+    for block in _chunks(file_descriptor):
+        digest.update(block)
     file_descriptor.seek(0)
-    return sha1.hexdigest()
+    return digest.hexdigest()
+
+
+def _map_file(file_descriptor):
+    """
+    Return a read-only memory map of a file with a real descriptor, or None
+    for in-memory and empty files, which cannot be mapped.
+    """
+    try:
+        fileno = file_descriptor.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _chunks(file_descriptor, size=BLOCK_SIZE):
+    """
+    Yield the contents of a file in blocks of at most size bytes.
+
+    Stops at the first empty read, so it terminates for both bytes and text
+    mode files.
+    """
+    while True:
+        block = file_descriptor.read(size)
+        if not block:
+            return
+        yield block
 
 
+@memoize
 def _resource(path):  # pragma: NO COVER
     """
     Handy helper for getting resources from our kit.
@@ -670,9 +790,15 @@ def render_template(template_path, context=None):  # pragma: NO COVER
     if context is None:
         context = {}
 
-    template_str = load_resource(template_path)
-    template = Template(template_str)
-    return template.render(Context(context))
+    return _get_template(template_path).render(Context(context))
+
+
+@memoize
+def _get_template(template_path):  # pragma: NO COVER
+    """
+    Compile a template by resource path.
+    """
+    return Template(load_resource(template_path))
 
 
 def require(assertion):
@@ -683,8 +809,21 @@ def require(assertion):
         raise PermissionDenied
 
 
-def check_user_access(user, course):
-    for level in ['instructor', 'staff']:
-        if has_access(user, level, course):
-            return True
-    return False
+def course_staff_user_ids(course_key):
+    """
+    Return ids of active users with a staff or instructor role on the course
+    or its organization.  Global staff are identified by user.is_staff and
+    are not included.
+    """
+    user_ids = set()
+    for role in (
+            CourseInstructorRole(course_key),
+            CourseStaffRole(course_key),
+            OrgInstructorRole(course_key.org),
+            OrgStaffRole(course_key.org)):
+        user_ids.update(
+            role.users_with_role().filter(is_active=True).values_list(
+                'id', flat=True)
+        )
+    return user_ids
+
@@ -3,6 +3,8 @@
 Tests for SGA
 """
 import datetime
+import hashlib
+import io
 from ddt import ddt, data
 import json
 import mock
@@ -674,3 +676,84 @@ class StaffGradedXBlockTests(ModuleStoreTestCase):
         block = self.make_one()
         block.due = datetime.datetime(2010, 5, 12, 2, 42, tzinfo=pytz.utc)
         self.assertTrue(block.past_due())
+
+    def test_get_sha1(self):
+        """
+        Test file digest uses BLAKE2b-160 where available, else SHA1, and the
+        file is rewound.
+        """
+        from edx_sga.sga import _get_sha1
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        data = open(path, 'rb').read()
+        if hasattr(hashlib, 'blake2b'):
+            expected = hashlib.blake2b(data, digest_size=20).hexdigest()
+        else:
+            expected = hashlib.sha1(data).hexdigest()
+        upload = DummyUpload(path, 'test.txt')
+        self.assertEqual(_get_sha1(upload), expected)
+        self.assertEqual(_get_sha1(upload), expected)
+
+    def test_chunks(self):
+        """
+        Test file blocks are yielded until the end of a bytes file.
+        """
+        from edx_sga.sga import _chunks
+        stream = io.BytesIO(b'abcdefg')
+        self.assertEqual(list(_chunks(stream, 3)), [b'abc', b'def', b'g'])
+
+    def test_get_sha1_mapped_file(self):
+        """
+        Test memory mapped and streamed files produce the same digest.
+        """
+        from edx_sga.sga import _get_sha1
+        path = pkg_resources.resource_filename(__package__, 'tests.py')
+        with open(path, 'rb') as mapped:
+            self.assertEqual(
+                _get_sha1(mapped),
+                _get_sha1(DummyUpload(path, 'test.txt'))
+            )
+
+    def test_staff_grading_data_excludes_course_staff(self):
+        """
+        Test enrolled course staff are left out of the grading screen.
+        """
+        from student.models import CourseEnrollment
+        from student.roles import CourseStaffRole
+        block = self.make_one()
+        fred = self.make_student(block, "fred")['module']
+        wilma = self.make_student(block, "wilma")['module']
+        CourseEnrollment.enroll(fred.student, self.course_id)
+        CourseEnrollment.enroll(wilma.student, self.course_id)
+        CourseStaffRole(self.course_id).add_users(wilma.student)
+        assignments = block.staff_grading_data()['assignments']
+        self.assertEqual(
+            [assignment['username'] for assignment in assignments], ['fred'])
+
+    def test_staff_grading_data_lists_inactive_course_staff(self):
+        """
+        Test inactive course staff are still listed as students.
+        """
+        from student.models import CourseEnrollment
+        from student.roles import CourseStaffRole
+        block = self.make_one()
+        wilma = self.make_student(block, "wilma")['module']
+        CourseEnrollment.enroll(wilma.student, self.course_id)
+        CourseStaffRole(self.course_id).add_users(wilma.student)
+        wilma.student.is_active = False
+        wilma.student.save()
+        assignments = block.staff_grading_data()['assignments']
+        self.assertEqual(
+            [assignment['username'] for assignment in assignments], ['wilma'])
+
+    def test_reified_values_computed_once(self):
+        """
+        Test reified values are only computed once per block.
+        """
+        block = self.make_one()
+        block.is_course_staff = mock.Mock(return_value=True)
+        block.get_score = mock.Mock(return_value=None)
+        for _ in range(3):
+            self.assertTrue(block.show_staff_grading_interface())
+            self.assertIsNone(block.score)
+        self.assertEqual(block.is_course_staff.call_count, 1)
+        self.assertEqual(block.get_score.call_count, 1)
@@ -27,6 +27,9 @@ setup(
     install_requires=[
         'XBlock',
     ],
+    extras_require={
+        'ujson': ['ujson'],
+    },
     entry_points={
         'xblock.v1': [
             'edx_sg_block = edx_sg_block.sga:StaffGradedXBlock',